@@ -1,24 +1,35 @@
 import os
-import uuid
+import asyncio
+import secrets
+import threading
 import time
 import base64
+import functools
+import hashlib
+import hmac
+import json
+import logging
 from io import BytesIO
-from typing import Optional, Dict, Literal
+from typing import Iterator, Optional, Dict, List, Literal, Set, Tuple
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
-import qrcode
+import segno
 from bakong_khqr import KHQR
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # =========================
 # CONFIG (.env recommended)
 # =========================
 BAKONG_TOKEN = os.getenv("BAKONG_TOKEN", "").strip()
+BAKONG_WEBHOOK_SECRET = os.getenv("BAKONG_WEBHOOK_SECRET", "").strip()  # empty => webhook disabled
 
 BANK_ACCOUNT = os.getenv("BANK_ACCOUNT", "yourname@aba").strip()
 MERCHANT_NAME = os.getenv("MERCHANT_NAME", "My Shop").strip()
@@ -28,11 +39,21 @@ PHONE = os.getenv("PHONE", "").strip()
 TERMINAL = os.getenv("TERMINAL", "POS-01").strip()
 DEFAULT_CURRENCY = os.getenv("CURRENCY", "USD").strip()  # "USD" or "KHR"
 SALE_TTL_SECONDS = int(os.getenv("SALE_TTL_SECONDS", "300"))  # default 5 minutes
+PAYMENT_POLL_INTERVAL_SECONDS = float(os.getenv("PAYMENT_POLL_INTERVAL_SECONDS", "2"))
+PAYMENT_POLL_CONCURRENCY = int(os.getenv("PAYMENT_POLL_CONCURRENCY", "8"))
+PAYMENT_CHECK_TIMEOUT_SECONDS = float(os.getenv("PAYMENT_CHECK_TIMEOUT_SECONDS", "10"))
+SALE_RETENTION_SECONDS = int(os.getenv("SALE_RETENTION_SECONDS", "3600"))  # keep finished sales 1h past expiry
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "60"))
 
 # Create KHQR instance (token needed only for check_payment)
 khqr = KHQR(BAKONG_TOKEN) if BAKONG_TOKEN else KHQR()
 
-app = FastAPI(title="POS KHQR Backend", version="1.0.0")
+# create_qr arguments that never change between sales
+_QR_STATIC = (BANK_ACCOUNT, MERCHANT_NAME, MERCHANT_CITY)
+_QR_TAIL = (STORE_LABEL, PHONE)
+
+# orjson serializes the small, frequent polling responses much faster than stdlib json
+app = FastAPI(title="POS KHQR Backend", version="1.0.0", default_response_class=ORJSONResponse)
 
 # =========================
 # CORS FIX (IMPORTANT)
@@ -40,12 +61,9 @@ app = FastAPI(title="POS KHQR Backend", version="1.0.0")
 # Allow your HTML server (Live Server usually uses 5500)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://127.0.0.1:5500",
-        "http://localhost:5500",
-        "http://127.0.0.1:5173",   # optional (Vite)
-        "http://localhost:5173",  # optional (Vite)
-    ],
+    # 127.0.0.1 / localhost on 5500 (Live Server) or 5173 (Vite, optional);
+    # one compiled regex instead of a list scan per request
+    allow_origin_regex=r"^http://(127\.0\.0\.1|localhost):(5173|5500)$",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -54,23 +72,231 @@ app.add_middleware(
 # =========================
 # In-memory storage (demo)
 # =========================
-SALES: Dict[str, dict] = {}
+class ShardedSales:
+    """
+    Sale records split across N lock-guarded dicts (N must be a power of 2).
 
+    Routes run both on the event loop and in FastAPI's threadpool, so
+    read-modify-write on a sale goes through lock(sale_id).
+    """
 
-def _refresh_sale_expiry(sale: dict) -> None:
-    """Mark sale EXPIRED if TTL passed and not already finalized."""
-    if sale.get("status") in ("PAID", "CANCELLED"):
-        return
-    now = int(time.time())
-    if now > int(sale.get("expired_at", 0)):
-        sale["status"] = "EXPIRED"
+    def __init__(self, n: int = 16):
+        self._mask = n - 1
+        self._shards: List[Dict[str, dict]] = [{} for _ in range(n)]
+        self._locks = [threading.Lock() for _ in range(n)]
+
+    def _index(self, sale_id: str) -> int:
+        return hash(sale_id) & self._mask
+
+    def lock(self, sale_id: str) -> threading.Lock:
+        return self._locks[self._index(sale_id)]
+
+    def get(self, sale_id: str) -> Optional[dict]:
+        i = self._index(sale_id)
+        with self._locks[i]:
+            return self._shards[i].get(sale_id)
+
+    def __setitem__(self, sale_id: str, sale: dict) -> None:
+        i = self._index(sale_id)
+        with self._locks[i]:
+            self._shards[i][sale_id] = sale
+
+    def pop(self, sale_id: str, default=None) -> Optional[dict]:
+        i = self._index(sale_id)
+        with self._locks[i]:
+            return self._shards[i].pop(sale_id, default)
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """Iterate a per-shard snapshot, safe against concurrent writes."""
+        for i, shard in enumerate(self._shards):
+            with self._locks[i]:
+                snapshot = list(shard.items())
+            yield from snapshot
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+
+SALES = ShardedSales()
+
+# Last background payment-check failure, cleared once a tick succeeds
+PAYMENT_CHECK_STATE: Dict[str, Optional[object]] = {"last_error": None, "last_error_at": None}
+
+# md5 -> sale_id, so webhook lookups don't scan every sale
+SALE_IDS_BY_MD5: Dict[str, str] = {}
+
+# Coarse epoch clock for expiry checks, ticked once a second by _tick_clock
+NOW = int(time.time())
 
+# Status sets used on every request; built once
+_TERMINAL_STATES = frozenset({"PAID", "CANCELLED"})
+_SWEEPABLE_STATES = frozenset({"EXPIRED", "CANCELLED", "PAID"})
+_PAID_RESULTS = frozenset({"PAID", "SUCCESS", "SUCCESSFUL", "COMPLETED"})
 
-def qr_png_base64(payload: str) -> str:
-    img = qrcode.make(payload)
+# WebSocket clients waiting on a sale: sale_id -> sockets
+SUBSCRIBERS: Dict[str, Set[WebSocket]] = {}
+
+
+def _refresh_sale_expiry(sale: dict) -> bool:
+    """Mark sale EXPIRED if TTL passed and still PENDING. Returns True if it changed."""
+    now = NOW
+    with SALES.lock(sale["sale_id"]):
+        if sale.get("status") != "PENDING":
+            return False
+        if now > int(sale.get("expired_at", 0)):
+            sale["status"] = "EXPIRED"
+            return True
+        return False
+
+
+def _render_qr_png(payload: str) -> bytes:
+    """Render payload as PNG bytes (rendered once per sale and stored on it)."""
+    # segno writes 1-bit PNGs natively, no PIL image allocation
+    qr = segno.make(payload, error="L")
     buf = BytesIO()
-    img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    qr.save(buf, kind="png", scale=4, border=2)
+    return buf.getvalue()
+
+
+@functools.lru_cache(maxsize=1024)
+def _qr_svg_cached(payload: str) -> bytes:
+    """Render payload as SVG; scales cleanly but is larger than the 1-bit PNG."""
+    qr = segno.make(payload, error="L")
+    buf = BytesIO()
+    # Keep xmlns so the file renders standalone in <img>; viewBox lets it scale freely
+    qr.save(buf, kind="svg", xmldecl=False, omitsize=True, scale=1, border=2)
+    return buf.getvalue()
+
+
+def qr_png_base64(png: bytes) -> str:
+    # base64 output is pure ASCII; skip the UTF-8 codec
+    return base64.b64encode(png).decode("ascii")
+
+
+async def _notify_sale(sale: dict) -> None:
+    """Push the current sale status to every WebSocket subscriber."""
+    message = {"sale_id": sale["sale_id"], "status": sale["status"], "md5": sale["md5"]}
+    for ws in list(SUBSCRIBERS.get(sale["sale_id"], ())):
+        try:
+            await ws.send_json(message)
+        except Exception:
+            SUBSCRIBERS.get(sale["sale_id"], set()).discard(ws)
+
+
+async def _expire_and_notify(sale: dict) -> bool:
+    """Refresh expiry and push EXPIRED to subscribers if it just changed."""
+    if _refresh_sale_expiry(sale):
+        await _notify_sale(sale)
+        return True
+    return False
+
+
+def _mark_paid(sale: dict) -> bool:
+    """Mark sale PAID unless already finalized. Returns True if it changed."""
+    with SALES.lock(sale["sale_id"]):
+        if sale["status"] in _TERMINAL_STATES:
+            return False
+        sale["status"] = "PAID"
+        sale["paid_at"] = int(time.time())
+    return True
+
+
+def _is_paid_result(result) -> bool:
+    # bakong-khqr typically returns strings like "UNPAID" / "PAID" (see PyPI docs).
+    # Make parsing robust in case a future version returns dict/objects.
+    if isinstance(result, str):
+        result_str = result.strip().strip('"').upper()
+    else:
+        result_str = str(result).strip().strip('"').upper()
+
+    # IMPORTANT: do NOT use substring checks like "PAID" in result_str
+    # because "UNPAID" contains "PAID" and would be treated as PAID.
+    return result_str in _PAID_RESULTS
+
+
+async def _poll_pending_payments() -> None:
+    """Check every PENDING sale against Bakong with bounded concurrency."""
+    semaphore = asyncio.Semaphore(PAYMENT_POLL_CONCURRENCY)
+
+    async def check(sale: dict) -> None:
+        async with semaphore:
+            # check_payment is a blocking HTTP call with no timeout of its own; keep it
+            # off the event loop and stop waiting so one hung call can't stall every tick
+            result = await asyncio.wait_for(
+                asyncio.to_thread(khqr.check_payment, sale["md5"]),
+                PAYMENT_CHECK_TIMEOUT_SECONDS,
+            )
+        if _is_paid_result(result) and _mark_paid(sale):
+            await _notify_sale(sale)
+
+    while True:
+        await asyncio.sleep(PAYMENT_POLL_INTERVAL_SECONDS)
+        try:
+            pending = []
+            for _, sale in SALES.items():
+                await _expire_and_notify(sale)
+                if sale["status"] == "PENDING":
+                    pending.append(sale)
+            results = await asyncio.gather(*(check(sale) for sale in pending), return_exceptions=True)
+            # Failed checks (bad token, network, Bakong errors) are retried next tick;
+            # log once per tick and keep the error visible via /health and /status
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors:
+                error = errors[0]
+                PAYMENT_CHECK_STATE["last_error"] = f"Payment check failed: {str(error) or type(error).__name__}"
+                PAYMENT_CHECK_STATE["last_error_at"] = int(time.time())
+                logger.error("Payment check failed for %d/%d pending sales: %r", len(errors), len(pending), error)
+            elif pending:
+                PAYMENT_CHECK_STATE["last_error"] = None
+                PAYMENT_CHECK_STATE["last_error_at"] = None
+        except Exception:
+            logger.exception("Payment poll failed")
+
+
+async def _sweep_sales_once() -> int:
+    """Drop finished sales older than expired_at + retention. Returns count removed."""
+    now = NOW
+    removed = 0
+    for sale_id, sale in SALES.items():
+        await _expire_and_notify(sale)
+        if sale["status"] not in _SWEEPABLE_STATES:
+            continue
+        if now - int(sale.get("expired_at", 0)) <= SALE_RETENTION_SECONDS:
+            continue
+        SALES.pop(sale_id, None)
+        SALE_IDS_BY_MD5.pop(sale["md5"], None)
+        removed += 1
+    return removed
+
+
+async def _tick_clock() -> None:
+    # Own task with nothing that can raise, so NOW never freezes
+    global NOW
+    while True:
+        await asyncio.sleep(1)
+        NOW = int(time.time())
+
+
+async def _push_expiries() -> None:
+    """Tell WebSocket subscribers when their sale expires, even if nobody polls."""
+    while True:
+        await asyncio.sleep(1)
+        try:
+            for sale_id in list(SUBSCRIBERS):
+                sale = SALES.get(sale_id)
+                if sale:
+                    await _expire_and_notify(sale)
+        except Exception:
+            logger.exception("Expiry push failed")
+
+
+async def _sweep_sales() -> None:
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        try:
+            await _sweep_sales_once()
+        except Exception:
+            logger.exception("Sale sweep failed")
 
 
 # =========================
@@ -88,7 +314,9 @@ class SaleCreateRes(BaseModel):
     amount: float
     currency: str
     md5: str
-    qr_png_base64: str
+    qr_png_url: str
+    qr_svg_url: str
+    qr_png_base64: Optional[str] = None
     status: str
     created_at: int
     expired_at: int
@@ -98,6 +326,27 @@ class SaleStatusRes(BaseModel):
     sale_id: str
     status: str
     md5: str
+    payment_check_error: Optional[str] = None
+
+
+# =========================
+# Background tasks
+# =========================
+_BACKGROUND_TASKS: set = set()
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    loops = [_tick_clock(), _push_expiries(), _sweep_sales()]
+    # No token => cannot verify payment, sales just stay PENDING
+    if BAKONG_TOKEN:
+        loops.append(_poll_pending_payments())
+
+    for loop in loops:
+        task = asyncio.create_task(loop)
+        # Hold a reference so the task isn't garbage-collected mid-loop
+        _BACKGROUND_TASKS.add(task)
+        task.add_done_callback(_BACKGROUND_TASKS.discard)
 
 
 # =========================
@@ -105,13 +354,20 @@ class SaleStatusRes(BaseModel):
 # =========================
 @app.get("/health")
 def health():
-    return {"ok": True, "payment_check_enabled": bool(BAKONG_TOKEN)}
+    return {
+        "ok": True,
+        "payment_check_enabled": bool(BAKONG_TOKEN),
+        "payment_check_error": PAYMENT_CHECK_STATE["last_error"],
+        "payment_check_error_at": PAYMENT_CHECK_STATE["last_error_at"],
+    }
 
 
 @app.post("/pos/sale", response_model=SaleCreateRes)
-def create_sale(req: SaleCreateReq):
-    sale_id = str(uuid.uuid4())
-    created_at = int(time.time())
+def create_sale(req: SaleCreateReq, include_base64: bool = False):
+    sale_id = secrets.token_hex(16)
+    created_at = NOW
+    amount = float(req.amount)
+    currency = req.currency or DEFAULT_CURRENCY
 
     # Unique bill number per sale
     bill_number = f"POS-{created_at}-{sale_id[:8]}"
@@ -121,40 +377,44 @@ def create_sale(req: SaleCreateReq):
 
     try:
         qr_string = khqr.create_qr(
-            BANK_ACCOUNT,
-            MERCHANT_NAME,
-            MERCHANT_CITY,
-            float(req.amount),
-            req.currency or DEFAULT_CURRENCY,
-            STORE_LABEL,
-            PHONE,
+            *_QR_STATIC,
+            amount,
+            currency,
+            *_QR_TAIL,
             bill_number,
             TERMINAL,
             False,  # static=False => dynamic (fixed amount)
         )
 
         md5 = khqr.generate_md5(qr_string)
+        qr_png = _render_qr_png(qr_string)
 
         SALES[sale_id] = {
             "sale_id": sale_id,
-            "amount": float(req.amount),
-            "currency": req.currency,
+            "amount": amount,
+            "currency": currency,
             "note": req.note,
             "cashier_id": req.cashier_id,
             "bill_number": bill_number,
             "md5": md5,
+            "qr_string": qr_string,
+            "qr_png": qr_png,
             "status": "PENDING",
             "created_at": created_at,
             "expired_at": expired_at,
             "paid_at": None,
         }
+        SALE_IDS_BY_MD5[md5] = sale_id
 
         return SaleCreateRes(
             sale_id=sale_id,
-            amount=float(req.amount),
-            currency=req.currency,
+            amount=amount,
+            currency=currency,
             md5=md5,
-            qr_png_base64=qr_png_base64(qr_string),
+            qr_png_url=f"/pos/sale/{sale_id}/qr.png",
+            qr_svg_url=f"/pos/sale/{sale_id}/qr.svg",
+            # base64-in-JSON is opt-in; clients should prefer <img src=qr_png_url>
+            qr_png_base64=qr_png_base64(qr_png) if include_base64 else None,
             status="PENDING",
             created_at=created_at,
             expired_at=expired_at,
@@ -165,12 +425,12 @@ def create_sale(req: SaleCreateReq):
 
 
 @app.get("/pos/sale/{sale_id}")
-def get_sale(sale_id: str):
+async def get_sale(sale_id: str):
     sale = SALES.get(sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
 
-    _refresh_sale_expiry(sale)
+    await _expire_and_notify(sale)
 
     return {
         "sale_id": sale["sale_id"],
@@ -187,57 +447,111 @@ def get_sale(sale_id: str):
     }
 
 
-@app.get("/pos/sale/{sale_id}/status", response_model=SaleStatusRes)
-def check_sale_status(sale_id: str):
+@app.get("/pos/sale/{sale_id}/qr.png")
+def get_sale_qr_png(sale_id: str):
     sale = SALES.get(sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
 
-    # Always refresh expiry here too (important for polling clients)
-    _refresh_sale_expiry(sale)
-
-    # If the sale expired, don't check payment, just mark it as expired
-    if sale["status"] == "EXPIRED":
-        return SaleStatusRes(sale_id=sale_id, status="EXPIRED", md5=sale["md5"])
+    return Response(content=sale["qr_png"], media_type="image/png")
 
-    # If already done, return quickly
-    if sale["status"] in ("PAID", "CANCELLED"):
-        return SaleStatusRes(sale_id=sale_id, status=sale["status"], md5=sale["md5"])
 
-    # No token => cannot verify payment (still return PENDING)
-    if not BAKONG_TOKEN:
-        return SaleStatusRes(sale_id=sale_id, status="PENDING", md5=sale["md5"])
+@app.get("/pos/sale/{sale_id}/qr.svg")
+def get_sale_qr_svg(sale_id: str):
+    sale = SALES.get(sale_id)
+    if not sale:
+        raise HTTPException(status_code=404, detail="Sale not found")
 
-    try:
-        result = khqr.check_payment(sale["md5"])
+    return Response(content=_qr_svg_cached(sale["qr_string"]), media_type="image/svg+xml")
 
-        # bakong-khqr typically returns strings like "UNPAID" / "PAID" (see PyPI docs).
-        # Make parsing robust in case a future version returns dict/objects.
-        if isinstance(result, str):
-            result_str = result.strip().strip('"').upper()
-        else:
-            result_str = str(result).strip().strip('"').upper()
 
-        # IMPORTANT: do NOT use substring checks like "PAID" in result_str
-        # because "UNPAID" contains "PAID" and would be treated as PAID.
-        if result_str in ("PAID", "SUCCESS", "SUCCESSFUL", "COMPLETED"):
-            sale["status"] = "PAID"
-            sale["paid_at"] = int(time.time())
-        # else: keep PENDING (covers UNPAID / NOT_FOUND etc.)
+# Hot polling path: return plain dicts, keep the schema only for OpenAPI
+@app.get("/pos/sale/{sale_id}/status", responses={200: {"model": SaleStatusRes}})
+async def check_sale_status(sale_id: str):
+    sale = SALES.get(sale_id)
+    if not sale:
+        raise HTTPException(status_code=404, detail="Sale not found")
 
-        return SaleStatusRes(sale_id=sale_id, status=sale["status"], md5=sale["md5"])
+    # Always refresh expiry here too (important for polling clients)
+    await _expire_and_notify(sale)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Payment check failed: {e}")
+    # Payment is confirmed by _poll_pending_payments (or the webhook);
+    # polling clients only read the stored status, never Bakong directly.
+    # Surface the poller's last failure (e.g. expired token) while still PENDING.
+    return {
+        "sale_id": sale_id,
+        "status": sale["status"],
+        "md5": sale["md5"],
+        "payment_check_error": PAYMENT_CHECK_STATE["last_error"] if sale["status"] == "PENDING" else None,
+    }
 
 
 @app.post("/pos/sale/{sale_id}/mark-cancelled")
-def cancel_sale(sale_id: str):
+async def cancel_sale(sale_id: str):
     sale = SALES.get(sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
-    if sale["status"] == "PAID":
-        raise HTTPException(status_code=400, detail="Cannot cancel a PAID sale")
+    with SALES.lock(sale_id):
+        if sale["status"] == "PAID":
+            raise HTTPException(status_code=400, detail="Cannot cancel a PAID sale")
+        sale["status"] = "CANCELLED"
+    await _notify_sale(sale)
+    return {"sale_id": sale_id, "status": "CANCELLED"}
+
+
+@app.post("/webhook/bakong")
+async def bakong_webhook(request: Request):
+    if not BAKONG_WEBHOOK_SECRET:
+        raise HTTPException(status_code=503, detail="Webhook not configured")
+
+    # Signature is HMAC-SHA256 (hex) of the raw body with the shared secret
+    body = await request.body()
+    expected = hmac.new(BAKONG_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    signature = request.headers.get("X-Signature", "")
+    if not hmac.compare_digest(expected, signature):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+
+    try:
+        payload = json.loads(body)
+        md5 = str(payload["md5"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+
+    sale_id = SALE_IDS_BY_MD5.get(md5)
+    sale = SALES.get(sale_id) if sale_id else None
+    if not sale:
+        raise HTTPException(status_code=404, detail="Sale not found")
+
+    if _mark_paid(sale):
+        await _notify_sale(sale)
+
+    return {"sale_id": sale["sale_id"], "status": sale["status"]}
 
-    sale["status"] = "CANCELLED"
-    return {"sale_id": sale_id, "status": "CANCELLED"}
\ No newline at end of file
+
+@app.websocket("/ws/sale/{sale_id}")
+async def sale_updates(websocket: WebSocket, sale_id: str):
+    sale = SALES.get(sale_id)
+    if not sale:
+        await websocket.close(code=4404)
+        return
+
+    await websocket.accept()
+
+    # Subscribe before sending the current status so a change landing
+    # during the send is still pushed (worst case the client sees it twice)
+    subscribers = SUBSCRIBERS.setdefault(sale_id, set())
+    subscribers.add(websocket)
+    try:
+        # If it just expired the push reaches this socket too; otherwise send directly
+        if not await _expire_and_notify(sale):
+            await websocket.send_json({"sale_id": sale_id, "status": sale["status"], "md5": sale["md5"]})
+
+        # Nothing to read from the client; just wait for it to go away
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        subscribers.discard(websocket)
+        if not subscribers and SUBSCRIBERS.get(sale_id) is subscribers:
+            del SUBSCRIBERS[sale_id]
\ No newline at end of file